@@ -17,7 +17,7 @@ def main():
     
     print(f"Indexing codebase in: {project_path}.....")
     
-    indexer = CodebaseIndexer(project_path)
+    indexer = CodebaseIndexer(project_path, verbose=bool(os.getenv('CODEBASE_AI_VERBOSE')))
     indexer.index()
     
     print("Indexing complete")
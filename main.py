@@ -1,11 +1,8 @@
 # main.py
 
 import os
-import shutil
 from pathlib import Path
-from utils.query_processor import QueryProcessor
 from dotenv import load_dotenv
-from utils.indexer import CodebaseIndexer
 
 load_dotenv()
 
@@ -36,34 +33,6 @@ def get_project_path():
         
         return project_path
 
-def check_for_recent_changes(project_path):
-    """Ask user if they've made recent changes and handle re-indexing"""
-    index_path = project_path / ".codebase_index"
-    
-    if index_path.exists():
-        print(f"\nFound existing codebase index at: {index_path}")
-        
-        while True:
-            response = input("Have you made any changes to the code recently? (y/n): ").strip().lower()
-            
-            if response in ['y', 'yes']:
-                print("Removing old index and re-indexing codebase...")
-                try:
-                    shutil.rmtree(index_path)
-                    print("Old index removed successfully.")
-                except Exception as e:
-                    print(f"Error removing old index: {e}")
-                return True  # Need to re-index
-            
-            elif response in ['n', 'no']:
-                print("Using existing index.")
-                return False  # Don't need to re-index
-            
-            else:
-                print("Please enter 'y' for yes or 'n' for no.")
-    
-    return True  # No existing index, need to create one
-
 def main():
     if not os.getenv('ANTHROPIC_API_KEY'):
         print("No API key provided. Please set ANTHROPIC_API_KEY in your .env file.")
@@ -76,14 +45,19 @@ def main():
     project_path = get_project_path()
     print(f"Selected project path: {project_path}")
     
-    # Check for recent changes and handle indexing
-    need_indexing = check_for_recent_changes(project_path)
+    # Deferred so the prompts above appear without waiting on heavy imports
+    from utils.embeddings import warm_up
+    from utils.indexer import CodebaseIndexer
+    from utils.query_processor import QueryProcessor
+    
+    # Only files added, changed or deleted since the last run are re-indexed
+    print("\nIndexing codebase...")
+    indexer = CodebaseIndexer(project_path, verbose=bool(os.getenv('CODEBASE_AI_VERBOSE')))
+    indexer.index()
+    print("Indexing complete!")
     
-    if need_indexing:
-        print("\nIndexing codebase...")
-        indexer = CodebaseIndexer(project_path)
-        indexer.index()
-        print("Indexing complete!")
+    # Load the embedding model while the user types their first query
+    warm_up()
     
     print("\n" + "="*50)
     print("Codebase AI is ready!")
@@ -1,72 +1,216 @@
 # database.py
+import sqlite3
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Dict, Any
-import chromadb
-from chromadb.config import Settings
+from typing import Iterator, List, Dict, Any, Set, Tuple
+import numpy as np
+
+# Bump when chunk IDs or stored embeddings change meaning (e.g. hash algorithm)
+INDEX_FORMAT = 6
+
+# Kept as one constant string so sqlite3's statement cache reuses the prepared statement
+INSERT_CHUNK_SQL = (
+    "INSERT OR IGNORE INTO chunks "
+    "(chunk_hash, file_path, chunk_type, name, start_line, end_line, content, embedding, embedding_scale) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+# Stay well under SQLite's bound-parameter limit
+IN_BATCH_SIZE = 500
+
+def select_in(conn: sqlite3.Connection, sql: str, values: List[Any]) -> Iterator[Tuple]:
+    """Rows of sql, whose {placeholders} is filled with an IN list, across batches of values"""
+    for i in range(0, len(values), IN_BATCH_SIZE):
+        batch = values[i:i + IN_BATCH_SIZE]
+        yield from conn.execute(sql.format(placeholders=", ".join("?" * len(batch))), batch)
 
 class EmbeddingDB:
     def __init__(self, db_path: Path):
         self.db_path = db_path
         self.db_path.mkdir(exist_ok=True)
         
-        self.client = chromadb.PersistentClient(
-            path=str(self.db_path),
-            settings=Settings(allow_reset=True)
-        )
+        self.conn = sqlite3.connect(str(self.db_path / "index.db"))
+        # WAL with synchronous=NORMAL fsyncs at checkpoints rather than on every commit
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+        self.conn.execute("PRAGMA cache_size = -200000")
+        self._in_transaction = False
+        self._create_schema()
+        
+        # relative file path -> (size, mtime_ns, content_hash) as of its last successful index
+        self.file_state = {
+            row[0]: (row[1], row[2], row[3])
+            for row in self.conn.execute("SELECT file_path, size, mtime_ns, content_hash FROM file_state")
+        }
+        
+        # Normalised embedding matrix for similarity search, loaded on first query
+        self._matrix = None
+        self._matrix_ids = []
+        self._data_version = None
+    
+    def _create_schema(self):
+        # Rows written in an older format can't be mixed with new ones, so start fresh
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != INDEX_FORMAT:
+            with self.conn:
+                self.conn.execute("DROP TABLE IF EXISTS chunks")
+                self.conn.execute("DROP TABLE IF EXISTS file_state")
+                self.conn.execute(f"PRAGMA user_version = {INDEX_FORMAT}")
         
-        self.collection = self.client.get_or_create_collection(
-            name="codebase_chunks",
-            metadata={"hnsw:space": "cosine"}
-        )
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    chunk_hash TEXT PRIMARY KEY,
+                    file_path TEXT NOT NULL,
+                    chunk_type TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    start_line INTEGER NOT NULL,
+                    end_line INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    embedding_scale REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS chunks_file_path ON chunks (file_path)")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS file_state (
+                    file_path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL
+                )
+            """)
     
-    def chunk_exists(self, chunk_hash: str) -> bool:
+    @contextmanager
+    def transaction(self):
+        """Group writes into one commit; nested uses join the outermost transaction"""
+        if self._in_transaction:
+            yield
+            return
+        
+        self._in_transaction = True
         try:
-            results = self.collection.get(ids=[chunk_hash])
-            return len(results['ids']) > 0
-        except:
-            return False
+            with self.conn:
+                yield
+        finally:
+            self._in_transaction = False
     
-    def store_chunk(self, file_path: str, chunk_hash: str, chunk_type: str, 
-                   name: str, start_line: int, end_line: int, content: str, 
-                   embedding: List[float]):
-        metadata = {
-            'file_path': file_path,
-            'chunk_type': chunk_type,
-            'name': name,
-            'start_line': start_line,
-            'end_line': end_line
-        }
+    def load_existing_ids(self) -> Set[str]:
+        return {row[0] for row in self.conn.execute("SELECT chunk_hash FROM chunks")}
+    
+    def store_chunks(self, chunks: List[Dict[str, Any]], embeddings: np.ndarray):
+        # Store unit vectors so cosine similarity is a plain dot product
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms > 0)
+        
+        # Quantise each row to int8 with its own scale: a quarter of the float32 size
+        scales = np.abs(embeddings).max(axis=1, keepdims=True) / 127
+        quantized = np.rint(
+            np.divide(embeddings, scales, out=np.zeros_like(embeddings), where=scales > 0)
+        ).astype(np.int8)
+        
+        rows = [
+            (chunk['hash'], chunk['file_path'], chunk['chunk_type'], chunk['name'],
+             chunk['start_line'], chunk['end_line'], chunk['content'], embedding.tobytes(), scale)
+            for chunk, embedding, scale in zip(chunks, quantized, scales[:, 0].tolist())
+        ]
         
-        self.collection.add(
-            embeddings=[embedding],
-            documents=[content],
-            metadatas=[metadata],
-            ids=[chunk_hash]
-        )
+        with self.transaction():
+            self.conn.executemany(INSERT_CHUNK_SQL, rows)
+        self._matrix = None
     
-    def similarity_search(self, query_embedding: List[float], top_k: int = 5) -> List[Dict[str, Any]]:
-        results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=top_k
-        )
+    def get_chunk_file_paths(self) -> Set[str]:
+        return {row[0] for row in self.conn.execute("SELECT DISTINCT file_path FROM chunks")}
+    
+    def get_chunk_ids_for_files(self, file_paths: List[str]) -> Dict[str, Set[str]]:
+        chunk_ids = {file_path: set() for file_path in file_paths}
+        for file_path, chunk_hash in select_in(
+            self.conn, "SELECT file_path, chunk_hash FROM chunks WHERE file_path IN ({placeholders})", file_paths
+        ):
+            chunk_ids[file_path].add(chunk_hash)
+        return chunk_ids
+    
+    def update_file_chunks(self, stale_ids: Set[str], kept_chunks: List[Dict[str, Any]]):
+        with self.transaction():
+            self.conn.executemany("DELETE FROM chunks WHERE chunk_hash = ?", [(chunk_id,) for chunk_id in stale_ids])
+            self.conn.executemany(
+                "UPDATE chunks SET chunk_type = ?, name = ?, start_line = ?, end_line = ? WHERE chunk_hash = ?",
+                [
+                    (chunk['chunk_type'], chunk['name'], chunk['start_line'], chunk['end_line'], chunk['hash'])
+                    for chunk in kept_chunks
+                ]
+            )
+        if stale_ids:
+            self._matrix = None
+    
+    def remove_files(self, file_paths: List[str]):
+        rows = [(file_path,) for file_path in file_paths]
+        with self.transaction():
+            self.conn.executemany("DELETE FROM chunks WHERE file_path = ?", rows)
+            self.conn.executemany("DELETE FROM file_state WHERE file_path = ?", rows)
+        for file_path in file_paths:
+            self.file_state.pop(file_path, None)
+        self._matrix = None
+    
+    def update_file_states(self, states: Dict[str, Tuple[int, int, str]]):
+        with self.transaction():
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO file_state VALUES (?, ?, ?, ?)",
+                [(file_path, *state) for file_path, state in states.items()]
+            )
+        self.file_state.update(states)
+    
+    def _load_matrix(self) -> Tuple[List[str], np.ndarray]:
+        # data_version changes when another connection (e.g. a separate
+        # CodebaseIndexer) commits, so a cached matrix is reloaded then
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._matrix is None or data_version != self._data_version:
+            rows = self.conn.execute("SELECT chunk_hash, embedding, embedding_scale FROM chunks").fetchall()
+            self._matrix_ids = [row[0] for row in rows]
+            self._matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.int8).astype(np.float32)
+            if rows:
+                scales = np.array([row[2] for row in rows], dtype=np.float32)
+                self._matrix = self._matrix.reshape(len(rows), -1) * scales[:, None]
+            self._data_version = data_version
+        return self._matrix_ids, self._matrix
+    
+    def similarity_search(self, query_embedding: np.ndarray, top_k: int = 5) -> List[Dict[str, Any]]:
+        ids, matrix = self._load_matrix()
+        if not ids:
+            return []
+        
+        # float32 like the matrix, so the product is a single sgemv with no upcast
+        query_embedding = np.ascontiguousarray(query_embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query_embedding)
+        if query_norm > 0:
+            query_embedding = query_embedding / query_norm
+        
+        scores = matrix @ query_embedding
+        top_k = min(top_k, len(ids))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        
+        hit_ids = [ids[i] for i in top]
+        rows = {
+            chunk_hash: fields
+            for chunk_hash, *fields in select_in(
+                self.conn,
+                "SELECT chunk_hash, file_path, chunk_type, name, start_line, end_line, content "
+                "FROM chunks WHERE chunk_hash IN ({placeholders})",
+                hit_ids
+            )
+        }
         
         return [
             {
-                'file_path': results['metadatas'][0][i]['file_path'],
-                'chunk_type': results['metadatas'][0][i]['chunk_type'],
-                'name': results['metadatas'][0][i]['name'],
-                'start_line': results['metadatas'][0][i]['start_line'],
-                'end_line': results['metadatas'][0][i]['end_line'],
-                'content': results['documents'][0][i],
-                'similarity': 1 - results['distances'][0][i]
+                'file_path': file_path,
+                'chunk_type': chunk_type,
+                'name': name,
+                'start_line': start_line,
+                'end_line': end_line,
+                'content': content,
+                'similarity': similarity
             }
-            for i in range(len(results['ids'][0]))
-        ]
-    
-    def remove_chunks_for_file(self, file_path: str):
-        try:
-            results = self.collection.get(where={"file_path": file_path})
-            if results['ids']:
-                self.collection.delete(ids=results['ids'])
-        except Exception as e:
-            print(f"Error removing chunks for {file_path}: {e}")
\ No newline at end of file
+            for (file_path, chunk_type, name, start_line, end_line, content), similarity
+            in zip((rows[chunk_hash] for chunk_hash in hit_ids), scores[top].tolist())
+        ]
\ No newline at end of file
@@ -0,0 +1,62 @@
+# embedding_cache.py
+import sqlite3
+from pathlib import Path
+from typing import Callable, List, Dict
+import blake3
+import numpy as np
+from .database import select_in
+
+class EmbeddingCache:
+    """Persistent text -> embedding cache keyed by whitespace-normalised content"""
+    
+    def __init__(self, cache_path: Path, model_name: str, max_entries: int):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(str(cache_path))
+        
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL
+                )
+            """)
+    
+    def key_for(self, text: str) -> str:
+        # The model's tokenizer treats every whitespace run alike, so texts that
+        # differ only in indentation or line breaks embed identically
+        normalized = " ".join(text.split())
+        return blake3.blake3(f"{self.model_name}\0{normalized}".encode()).hexdigest(length=16)
+    
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        for key, vector in select_in(
+            self.conn, "SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", keys
+        ):
+            found[key] = np.frombuffer(vector, dtype=np.float32)
+        return found
+    
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        if not keys:
+            return
+        
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in zip(keys, vectors)]
+            )
+            # A replaced row gets a new rowid, so the lowest rowids are the least recently written
+            self.conn.execute(
+                "DELETE FROM embeddings WHERE rowid <= (SELECT MAX(rowid) FROM embeddings) - ?",
+                (self.max_entries,)
+            )
+    
+    def get_or_compute(self, text: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        key = self.key_for(text)
+        row = self.conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            return np.frombuffer(row[0], dtype=np.float32)
+        
+        vector = np.asarray(compute(), dtype=np.float32)
+        self.put_many([key], [vector])
+        return vector
\ No newline at end of file
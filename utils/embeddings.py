@@ -1,15 +1,42 @@
 # embeddings.py
+import threading
 from typing import List
-from langchain_huggingface import HuggingFaceEmbeddings
-
-embeddings_model = HuggingFaceEmbeddings(
-    model_name="sentence-transformers/all-MiniLM-L6-v2"
-)
-
-def get_embedding(text: str) -> List[float]:
-    try:
-        embedding = embeddings_model.embed_query(text)
-        return embedding
-    except Exception as e:
-        print(f"Error generating embedding: {e}")
-        return [0.0] * 384
\ No newline at end of file
+import numpy as np
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+
+_model_instance = None
+_model_lock = threading.Lock()
+
+def _model():
+    # Loaded on first use so importing utils doesn't pay for the model load;
+    # fastembed runs the ONNX export of the model through ONNX Runtime. The lock
+    # makes a caller wait for a load that warm_up() already started
+    global _model_instance
+    if _model_instance is None:
+        with _model_lock:
+            if _model_instance is None:
+                from fastembed import TextEmbedding
+                _model_instance = TextEmbedding(model_name=MODEL_NAME)
+    return _model_instance
+
+def warm_up():
+    """Start loading the model on a background thread"""
+    def load():
+        try:
+            _model()
+        except Exception:
+            # The next real embedding call retries and reports the error
+            pass
+    
+    threading.Thread(target=load, daemon=True).start()
+
+def get_embedding(text: str) -> np.ndarray:
+    """Embed a query as a float32 vector; raises if the model can't be loaded or run"""
+    return next(iter(_model().query_embed(text))).astype(np.float32, copy=False)
+
+
+def get_embeddings_batch(texts: List[str]) -> np.ndarray:
+    """Embed texts as one (len(texts), EMBEDDING_DIM) float32 matrix; raises if the model can't be loaded or run"""
+    return np.stack(list(_model().embed(texts))).astype(np.float32, copy=False)
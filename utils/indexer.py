@@ -1,200 +1,457 @@
 # indexer.py
-import hashlib
 import logging
+import logging.handlers
+import mmap
+import multiprocessing
+import os
+import re
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any
-from tree_sitter_language_pack import get_parser
-from tree_sitter import Node
+from typing import List, Dict, Any, Iterator, Optional, Set, Tuple, Union
+import blake3
+import numpy as np
+import pathspec
+from tree_sitter_language_pack import get_language, get_parser
+from tree_sitter import Node, Parser, Query, QueryCursor, Tree
 from .database import EmbeddingDB
-from .embeddings import get_embedding
+from .embedding_cache import EmbeddingCache
+from .embeddings import MODEL_NAME, EMBEDDING_DIM, get_embeddings_batch
+from .source_file import hash_source, line_offsets, map_source
 
+_log_file = logging.FileHandler('manage.log', mode='w', delay=True)
+_log_file.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+# Records are buffered and written in bulk; errors flush the buffer immediately
 logging.basicConfig(
-    filename='manage.log',
-    filemode='w',
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+    handlers=[logging.handlers.MemoryHandler(1000, flushLevel=logging.ERROR, target=_log_file)]
 )
 logger = logging.getLogger(__name__)
 
 class CodebaseIndexer:
-    def __init__(self, project_path: Path):
+    IGNORED_DIRS = {'node_modules', '__pycache__', 'venv', 'env', 'dist', 'build'}
+    LANGUAGES = {'py': 'python', 'js': 'javascript'}
+    SOURCE_FILE_RE = re.compile(r'.+\.(%s)' % '|'.join(LANGUAGES))
+    NODE_KINDS = {
+        'python': {
+            'import_statement': 'Import',
+            'import_from_statement': 'Import',
+            'function_definition': 'FunctionDef',
+            'async_function_definition': 'FunctionDef',
+            'class_definition': 'ClassDef',
+            'decorated_definition': 'Decorated',
+            'assignment': 'Statement'
+        },
+        'javascript': {
+            'import_statement': 'Import',
+            'import_declaration': 'Import',
+            'function_declaration': 'FunctionDef',
+            'function_expression': 'FunctionDef',
+            'arrow_function': 'FunctionDef',
+            'class_declaration': 'ClassDef',
+            'assignment': 'Statement'
+        }
+    }
+    _parsers: Dict[str, Parser] = {}
+    _queries: Dict[str, Query] = {}
+    # Up to this many files (e.g. a re-index after an edit) parse faster inline than
+    # with worker processes to start
+    INLINE_PARSE_FILES = 8
+    # Pending chunks are length-sorted across this many batches before embedding
+    SORT_WINDOW_BATCHES = 8
+    # Chunk embeddings kept for re-use across edits; the index itself holds every live chunk
+    EMBEDDING_CACHE_LIMIT = 100000
+    
+    def __init__(self, project_path: Path, batch_size: int = 128, verbose: bool = False):
         self.project_path = project_path
+        self.batch_size = batch_size
+        self.verbose = verbose
         self.db = EmbeddingDB(project_path / ".codebase_index")
+        self._embedding_cache = EmbeddingCache(
+            project_path / ".codebase_index" / "embedding_cache.db", MODEL_NAME, self.EMBEDDING_CACHE_LIMIT
+        )
+        self._existing_ids = self.db.load_existing_ids()
+        self._ignore_spec = self._load_ignore_spec()
+    
+    def __getstate__(self):
+        # Parse workers only need the chunking methods, not the open databases
+        return {'project_path': self.project_path, 'batch_size': self.batch_size}
     
     def index(self):
-        for file_path in self._discover_files():
+        file_paths = self._discover_files()
+        
+        # Drop everything stored for files that have since been deleted, including
+        # chunks of a file whose state was never recorded (e.g. its embedding failed)
+        live_paths = {str(file_path.relative_to(self.project_path)) for file_path in file_paths}
+        stored_paths = set(self.db.file_state) | self.db.get_chunk_file_paths()
+        deleted_paths = sorted(stored_paths - live_paths)
+        if deleted_paths:
+            self.db.remove_files(deleted_paths)
+            self._existing_ids = self.db.load_existing_ids()
+        
+        indexed, failed = self.index_files(file_paths)
+        summary = f"Indexed {indexed} new or changed files ({len(file_paths)} total)"
+        if failed:
+            summary += f", {failed} failed (see manage.log)"
+        print(summary)
+    
+    def index_files(self, file_paths: List[Path], force: bool = False) -> Tuple[int, int]:
+        # One commit for the whole run instead of one per batch
+        with self.db.transaction():
+            return self._index_files(file_paths, force)
+    
+    def _index_files(self, file_paths: List[Path], force: bool) -> Tuple[int, int]:
+        failed = 0
+        pending = []
+        seen = set()
+        file_states = {}
+        indexed_states = {}
+        reparsed = set()
+        
+        for file_path in file_paths:
+            relative_path = str(file_path.relative_to(self.project_path))
             try:
-                self._index_file(file_path)
-                print(f"Indexed: {file_path}")
+                stat = file_path.stat()
+            except OSError as e:
+                logger.error("Error indexing %s: %s", file_path, e)
+                failed += 1
+                continue
+            
+            # Unchanged since the last successful index: skip reading and parsing
+            state = (stat.st_size, stat.st_mtime_ns)
+            known_state = self.db.file_state.get(relative_path)
+            if force or known_state is None or known_state[:2] != state:
+                file_states[file_path] = (relative_path, state, known_state[2] if known_state else None)
+        
+        # Chunk IDs already stored for every file about to be parsed, in one query; a file
+        # without a recorded state can still have some, from a run that failed part-way
+        old_ids = self.db.get_chunk_ids_for_files([relative_path for relative_path, _, _ in file_states.values()])
+        stale_ids = set()
+        kept = []
+        unembedded = set()
+        
+        for file_path, future in self._parse_files(
+            [(file_path, relative_path, known_hash) for file_path, (relative_path, _, known_hash) in file_states.items()]
+        ):
+            try:
+                content_hash, chunks = future.result()
             except Exception as e:
-                print(f"Error indexing {file_path}: {e}")
-                logger.error(f"Error indexing {file_path}: {e}")
+                logger.error("Error indexing %s: %s", file_path, e)
+                failed += 1
+                continue
+            
+            relative_path, state, _ = file_states[file_path]
+            indexed_states[relative_path] = (*state, content_hash)
+            # Touched but byte-identical (e.g. a checkout or save without edits)
+            if chunks is None:
+                continue
+            reparsed.add(relative_path)
+            if self.verbose:
+                print(f"Indexed: {file_path}")
+            
+            # Chunks that survived the edit keep their embedding but may have moved,
+            # so their line ranges are refreshed and the ones that are gone deleted
+            if old_ids[relative_path]:
+                hashes = {chunk['hash'] for chunk in chunks}
+                stale_ids |= old_ids[relative_path] - hashes
+                kept.extend(chunk for chunk in chunks if chunk['hash'] in old_ids[relative_path])
+            
+            for chunk in chunks:
+                if chunk['hash'] in seen or chunk['hash'] in self._existing_ids:
+                    continue
+                seen.add(chunk['hash'])
+                pending.append(chunk)
+                
+                if len(pending) >= self.batch_size * self.SORT_WINDOW_BATCHES:
+                    unembedded |= self._store_chunks(pending)
+                    pending = []
+        
+        if pending:
+            unembedded |= self._store_chunks(pending)
+        
+        if stale_ids or kept:
+            self.db.update_file_chunks(stale_ids, kept)
+            self._existing_ids -= stale_ids
+        
+        # A file with chunks the model failed to embed stays unrecorded, so the next run retries it
+        for relative_path in unembedded:
+            logger.error("Error indexing %s: embedding failed, will retry on the next run", relative_path)
+            indexed_states.pop(relative_path, None)
+        failed += len(unembedded)
+        
+        # Recorded only once every chunk is stored, so an interrupted run re-reads these files
+        self.db.update_file_states(indexed_states)
+        return len(reparsed - unembedded), failed
     
-    def _discover_files(self) -> List[Path]:
-        files = []
-        for ext in ["*.py", "*.js"]:
-            files.extend([f for f in self.project_path.rglob(ext) 
-                         if not any(part.startswith('.') for part in f.parts)])
-        return files
-    
-    def _index_file(self, file_path: Path):
-        with open(file_path, 'rb') as f:
-            source_code = f.read()
-        
-        if file_path.suffix == '.py':
-            parser = get_parser('python')
-            node_types = {
-                'imports': ['import_statement', 'import_from_statement'],
-                'functions': ['function_definition', 'async_function_definition'],
-                'classes': ['class_definition'],
-                'decorated': ['decorated_definition']
-            }
-        elif file_path.suffix == '.js':
-            parser = get_parser('javascript')
-            node_types = {
-                'imports': ['import_statement', 'import_declaration'],
-                'functions': ['function_declaration', 'function_expression', 'arrow_function'],
-                'classes': ['class_declaration'],
-                'decorated': []
-            }
-        else:
+    def _load_ignore_spec(self) -> pathspec.PathSpec:
+        gitignore = self.project_path / ".gitignore"
+        lines = gitignore.read_text().splitlines() if gitignore.is_file() else []
+        return pathspec.PathSpec.from_lines('gitwildmatch', lines)
+    
+    def _parse_files(self, files: List[Tuple[Path, str, Optional[str]]]) -> Iterator[Tuple[Path, Future]]:
+        if len(files) <= self.INLINE_PARSE_FILES:
+            for file_path, relative_path, known_hash in files:
+                future = Future()
+                try:
+                    future.set_result(self._index_file(file_path, relative_path, known_hash))
+                except Exception as e:
+                    future.set_exception(e)
+                yield file_path, future
             return
         
+        # Parsing is CPU-bound and independent per file, so it runs in worker
+        # processes while the caller embeds earlier chunks; the bounded window
+        # keeps memory flat when embedding is the bottleneck
+        workers = min(len(files), os.cpu_count() or 1)
+        # Workers start from a fresh interpreter rather than a fork, because this can
+        # run on a thread of a multithreaded process (QueryProcessor's background re-index)
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method)) as pool:
+            in_flight = deque()
+            for file_path, relative_path, known_hash in files:
+                in_flight.append((file_path, pool.submit(self._index_file, file_path, relative_path, known_hash)))
+                if len(in_flight) >= workers * 4:
+                    yield in_flight.popleft()
+            while in_flight:
+                yield in_flight.popleft()
+    
+    def _discover_files(self) -> List[Path]:
+        return [Path(entry.path) for entry in self._scandir_walk(self.project_path)]
+    
+    def _scandir_walk(self, root: Path) -> Iterator[os.DirEntry]:
+        root_len = len(str(self.project_path)) + 1
+        stack = [str(root)]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.name.startswith('.') or entry.name in self.IGNORED_DIRS:
+                        continue
+                    
+                    if entry.is_dir(follow_symlinks=False):
+                        relative_path = entry.path[root_len:].replace(os.sep, '/')
+                        if not self._ignore_spec.match_file(relative_path + '/'):
+                            stack.append(entry.path)
+                    elif self.SOURCE_FILE_RE.fullmatch(entry.name) and entry.is_file():
+                        relative_path = entry.path[root_len:].replace(os.sep, '/')
+                        if not self._ignore_spec.match_file(relative_path):
+                            yield entry
+    
+    def _index_file(self, file_path: Path, relative_path: str,
+                    known_hash: Optional[str] = None) -> Tuple[str, Optional[List[Dict[str, Any]]]]:
+        # Mapped rather than read, so an unchanged file is hashed from the page cache without a copy
+        source_code = map_source(file_path)
+        
+        # Chunks come back as None when the content matches what was last indexed
+        content_hash = hash_source(source_code)
+        if content_hash == known_hash:
+            return content_hash, None
+        
+        match = self.SOURCE_FILE_RE.fullmatch(file_path.name)
+        language = self.LANGUAGES[match.group(1)] if match else None
+        
+        node_kinds = self.NODE_KINDS.get(language)
+        if node_kinds is None:
+            return content_hash, []
+        
+        # Parsers and queries are built once per process rather than once per file
+        parser = self._parsers.get(language)
+        if parser is None:
+            parser = self._parsers[language] = get_parser(language)
+            self._queries[language] = self._build_query(language, node_kinds)
+        
         tree = parser.parse(source_code)
-        processed_lines = set()
+        # Node slices of a memoryview are zero-copy; bytes are only materialised at decode time
+        source_view = memoryview(source_code)
+        chunks = []
         
-        imports = self._collect_nodes(tree.root_node, node_types['imports'])
+        imports, candidates = self._collect_nodes(tree, self._queries[language])
+        import_lines = (0, -1)
         if imports:
-            self._process_node_group(file_path, source_code, imports, 'Import', 'imports', processed_lines)
+            import_lines = self._process_node_group(relative_path, source_view, imports, 'Import', 'imports', chunks)
+        
+        self._process_candidates(candidates, relative_path, source_view, import_lines, chunks)
         
-        self._walk_tree(tree.root_node, file_path, source_code, node_types, processed_lines)
+        self._process_remaining_lines(relative_path, source_code, chunks)
         
-        lines = source_code.decode('utf-8').split('\n')
-        self._process_remaining_lines(file_path, lines, processed_lines)
+        return content_hash, chunks
     
-    def _collect_nodes(self, node: Node, node_types: List[str]) -> List[Node]:
-        nodes = []
-        if node.type in node_types:
-            nodes.append(node)
-        for child in node.children:
-            nodes.extend(self._collect_nodes(child, node_types))
-        return nodes
+    def _build_query(self, language: str, node_kinds: Dict[str, str]) -> Query:
+        # One pattern per node type, captured under its chunk kind; types the
+        # grammar doesn't define would make the whole query fail to compile
+        ts_language = get_language(language)
+        patterns = [
+            f"({node_type}) @{kind}" for node_type, kind in node_kinds.items()
+            if ts_language.id_for_node_kind(node_type, True) is not None
+        ]
+        return Query(ts_language, " ".join(patterns))
     
-    def _process_node_group(self, file_path: Path, source_code: bytes, nodes: List[Node], 
-                           chunk_type: str, name: str, processed_lines: set):
-        if not nodes:
-            return
-        
-        start_line = min(n.start_point[0] for n in nodes)
-        end_line = max(n.end_point[0] for n in nodes)
+    def _collect_nodes(self, tree: Tree, query: Query) -> Tuple[List[Node], List[Tuple[Node, str]]]:
+        # The query matches every pattern in C in one call; sorting by start and
+        # then widest span first restores preorder for the candidates
+        captures = QueryCursor(query).captures(tree.root_node)
+        imports = captures.pop('Import', [])
+        candidates = sorted(
+            ((node, kind) for kind, nodes in captures.items() for node in nodes),
+            key=lambda candidate: (candidate[0].start_byte, -candidate[0].end_byte)
+        )
+        return imports, candidates
+    
+    def _process_node_group(self, relative_path: str, source_view: memoryview, nodes: List[Node], 
+                           chunk_type: str, name: str, chunks: List[Dict[str, Any]]) -> Tuple[int, int]:
+        start_line = min(n.start_point[0] for n in nodes) + 1
+        end_line = max(n.end_point[0] for n in nodes) + 1
         start_byte = min(n.start_byte for n in nodes)
         end_byte = max(n.end_byte for n in nodes)
         
-        content = source_code[start_byte:end_byte].decode('utf-8')
+        content = source_view[start_byte:end_byte]
         
-        self._store_chunk(file_path, content, chunk_type, name, start_line + 1, end_line + 1)
-        
-        for line_num in range(start_line, end_line + 1):
-            processed_lines.add(line_num + 1)
+        chunks.append(self._make_chunk(relative_path, content, chunk_type, name, start_line, end_line))
+        return start_line, end_line
     
-    def _walk_tree(self, node: Node, file_path: Path, source_code: bytes, 
-                  node_types: Dict[str, List[str]], processed_lines: set):
-        if node.type in node_types['decorated']:
-            self._process_decorated(node, file_path, source_code, processed_lines)
-        elif node.type in node_types['functions']:
-            self._process_single_node(file_path, source_code, node, 'FunctionDef', processed_lines)
-        elif node.type in node_types['classes']:
-            self._process_single_node(file_path, source_code, node, 'ClassDef', processed_lines)
-        elif node.type == 'assignment':
-            self._process_single_node(file_path, source_code, node, 'Statement', processed_lines)
-        
-        for child in node.children:
-            self._walk_tree(child, file_path, source_code, node_types, processed_lines)
+    def _process_candidates(self, candidates: List[Tuple[Node, str]], relative_path: str, source_view: memoryview,
+                            import_lines: Tuple[int, int], chunks: List[Dict[str, Any]]):
+        # Candidates are in preorder and chunks don't overlap, so a candidate starting
+        # on or before the last chunk's end line is inside it or shares its line
+        import_start, import_end = import_lines
+        last_end_line = 0
+        for node, kind in candidates:
+            start_line = node.start_point[0] + 1
+            if start_line <= last_end_line or import_start <= start_line <= import_end:
+                continue
+            
+            if kind == 'Decorated':
+                chunked = self._process_decorated(node, relative_path, source_view, chunks)
+            else:
+                chunked = self._process_single_node(relative_path, source_view, node, kind, chunks)
+            
+            if chunked:
+                last_end_line = node.end_point[0] + 1
     
-    def _process_decorated(self, node: Node, file_path: Path, source_code: bytes, processed_lines: set):
-        if node.start_point[0] + 1 in processed_lines:
-            return
-        
+    def _process_decorated(self, node: Node, relative_path: str, source_view: memoryview,
+                          chunks: List[Dict[str, Any]]) -> bool:
         func_node = next((child for child in node.children 
                          if child.type in ['function_definition', 'async_function_definition', 'class_definition']), None)
         
         if func_node:
-            content = source_code[node.start_byte:node.end_byte].decode('utf-8')
-            name = self._get_node_name(func_node, source_code)
+            content = source_view[node.start_byte:node.end_byte]
+            name = self._get_node_name(func_node, source_view)
             chunk_type = 'FunctionDef' if func_node.type in ['function_definition', 'async_function_definition'] else 'ClassDef'
             
-            self._store_chunk(file_path, content, chunk_type, name, 
-                            node.start_point[0] + 1, node.end_point[0] + 1)
-            
-            for line_num in range(node.start_point[0], node.end_point[0] + 1):
-                processed_lines.add(line_num + 1)
-    
-    def _process_single_node(self, file_path: Path, source_code: bytes, node: Node, 
-                           chunk_type: str, processed_lines: set):
-        if node.start_point[0] + 1 in processed_lines:
-            return
-        
-        content = source_code[node.start_byte:node.end_byte].decode('utf-8')
-        name = self._get_node_name(node, source_code) if chunk_type in ['FunctionDef', 'ClassDef'] else 'code_block'
+            chunks.append(self._make_chunk(relative_path, content, chunk_type, name, 
+                                           node.start_point[0] + 1, node.end_point[0] + 1))
+            return True
         
-        self._store_chunk(file_path, content, chunk_type, name, 
-                        node.start_point[0] + 1, node.end_point[0] + 1)
+        return False
+    
+    def _process_single_node(self, relative_path: str, source_view: memoryview, node: Node, 
+                           chunk_type: str, chunks: List[Dict[str, Any]]) -> bool:
+        content = source_view[node.start_byte:node.end_byte]
+        name = self._get_node_name(node, source_view) if chunk_type in ['FunctionDef', 'ClassDef'] else 'code_block'
         
-        for line_num in range(node.start_point[0], node.end_point[0] + 1):
-            processed_lines.add(line_num + 1)
+        chunks.append(self._make_chunk(relative_path, content, chunk_type, name, 
+                                       node.start_point[0] + 1, node.end_point[0] + 1))
+        return True
+    
+    def _get_node_name(self, node: Node, source_view: memoryview) -> str:
+        # The grammar's 'name' field is a direct C-level lookup, and unlike the first
+        # identifier child it never picks up an arrow function's parameter
+        name_node = node.child_by_field_name('name')
+        if name_node is None:
+            return ""
+        return str(source_view[name_node.start_byte:name_node.end_byte], 'utf-8')
     
-    def _get_node_name(self, node: Node, source_code: bytes) -> str:
-        for child in node.children:
-            if child.type == 'identifier':
-                return source_code[child.start_byte:child.end_byte].decode('utf-8')
-        return ""
+    def _uncovered_ranges(self, chunks: List[Dict[str, Any]], line_count: int) -> Iterator[Tuple[int, int]]:
+        # Sweep the chunks' line intervals in order and yield the gaps between them
+        next_line = 1
+        for start_line, end_line in sorted((chunk['start_line'], chunk['end_line']) for chunk in chunks):
+            if start_line > next_line:
+                yield next_line, start_line - 1
+            next_line = max(next_line, end_line + 1)
+        if next_line <= line_count:
+            yield next_line, line_count
     
-    def _process_remaining_lines(self, file_path: Path, lines: List[str], processed_lines: set):
-        chunk_lines = []
-        start_line = None
+    def _process_remaining_lines(self, relative_path: str, source_code: Union[bytes, mmap.mmap],
+                                chunks: List[Dict[str, Any]]):
+        # A run of lines is one slice of source_code instead of a join over a line list
+        offsets = line_offsets(source_code).tolist()
         
-        for i, line in enumerate(lines, 1):
-            if i not in processed_lines:
-                if not chunk_lines and (not line.strip() or line.strip().startswith('#')):
-                    continue
-                
-                if not chunk_lines:
+        # Runs of statements split on blank lines and never cross a chunk
+        for gap_start, gap_end in self._uncovered_ranges(chunks, len(offsets) - 1):
+            start_line = None
+            for i in range(gap_start, gap_end + 1):
+                stripped = source_code[offsets[i - 1]:offsets[i]].strip()
+                if start_line is None:
+                    if not stripped or stripped.startswith(b'#'):
+                        continue
                     start_line = i
-                chunk_lines.append(line)
                 
-                if not line.strip() or i == len(lines):
-                    if chunk_lines and any(l.strip() for l in chunk_lines):
-                        content = '\n'.join(chunk_lines).strip()
-                        self._store_chunk(file_path, content, 'Statement', 'code_block', 
-                                        start_line, start_line + len(chunk_lines) - 1)
-                    chunk_lines = []
+                if not stripped or i == gap_end:
+                    self._append_line_chunk(relative_path, source_code, offsets, start_line, i, chunks)
                     start_line = None
     
-    def _store_chunk(self, file_path: Path, content: str, chunk_type: str, name: str, 
-                    start_line: int, end_line: int):
-        chunk_hash = hashlib.md5(content.encode()).hexdigest()
+    def _append_line_chunk(self, relative_path: str, source_code: Union[bytes, mmap.mmap], offsets: List[int],
+                           start_line: int, end_line: int, chunks: List[Dict[str, Any]]):
+        content = source_code[offsets[start_line - 1]:offsets[end_line]].strip()
+        chunks.append(self._make_chunk(relative_path, content, 'Statement', 'code_block', start_line, end_line))
+    
+    def _make_chunk(self, relative_path: str, content: Union[bytes, memoryview], chunk_type: str, name: str, 
+                   start_line: int, end_line: int) -> Dict[str, Any]:
+        # The path is part of the ID so each file owns its chunks and a re-index
+        # of one file can never delete or move another file's rows
+        chunk_id = blake3.blake3(relative_path.encode())
+        chunk_id.update(b'\0')
+        chunk_id.update(content)
         
-        if self.db.chunk_exists(chunk_hash):
-            return
+        return {
+            'hash': chunk_id.hexdigest(length=16),
+            'file_path': relative_path,
+            'chunk_type': chunk_type,
+            'name': name,
+            'start_line': start_line,
+            'end_line': end_line,
+            'content': str(content, 'utf-8')
+        }
+    
+    def _embed_chunks(self, chunks: List[Dict[str, Any]]) -> np.ndarray:
+        keys = [self._embedding_cache.key_for(chunk['content']) for chunk in chunks]
+        cached = self._embedding_cache.get_many(keys)
         
-        relative_path = file_path.relative_to(self.project_path)
-        embedding = get_embedding(content)
-        
-        self.db.store_chunk(
-            file_path=str(relative_path),
-            chunk_hash=chunk_hash,
-            chunk_type=chunk_type,
-            name=name,
-            start_line=start_line,
-            end_line=end_line,
-            content=content,
-            embedding=embedding
-        )
+        embeddings = np.empty((len(chunks), EMBEDDING_DIM), dtype=np.float32)
+        missing = []
+        for i, key in enumerate(keys):
+            if key in cached:
+                embeddings[i] = cached[key]
+            else:
+                missing.append(i)
+        
+        if missing:
+            new_embeddings = get_embeddings_batch([chunks[i]['content'] for i in missing])
+            embeddings[missing] = new_embeddings
+            self._embedding_cache.put_many([keys[i] for i in missing], new_embeddings)
+        
+        return embeddings
+    
+    def _store_chunks(self, chunks: List[Dict[str, Any]]) -> Set[str]:
+        # Batching similar lengths together keeps padding to each batch's longest text small
+        chunks = sorted(chunks, key=lambda chunk: len(chunk['content']))
+        unembedded = set()
+        
+        for i in range(0, len(chunks), self.batch_size):
+            batch = chunks[i:i + self.batch_size]
+            try:
+                embeddings = self._embed_chunks(batch)
+            except Exception as e:
+                # Left unstored, so their files are parsed and embedded again on the next run
+                logger.error("Error embedding %d chunks: %s", len(batch), e)
+                unembedded.update(chunk['file_path'] for chunk in batch)
+                continue
+            
+            self.db.store_chunks(batch, embeddings)
+            self._existing_ids.update(chunk['hash'] for chunk in batch)
+            
+            for chunk in batch:
+                logger.info("Stored chunk %s %s %s %s %d-%d", chunk['hash'], chunk['file_path'],
+                            chunk['chunk_type'], chunk['name'], chunk['start_line'], chunk['end_line'])
         
-        logger.info(f"Stored chunk: {chunk_hash}")
-        logger.info(f"  File: {relative_path}")
-        logger.info(f"  Type: {chunk_type}")
-        logger.info(f"  Name: {name}")
-        logger.info(f"  Lines: {start_line}-{end_line}")
-        logger.info(f"  Content: \n{content[:100]}...")
-        logger.info("-" * 50)
\ No newline at end of file
+        return unembedded
\ No newline at end of file
@@ -1,80 +1,289 @@
 # query_processor.py
 import os
 import json
-import re
 import logging
+import mmap
+import shutil
+import sys
 from pathlib import Path
-from typing import List, Dict, Any
-from langchain_anthropic import ChatAnthropic
-from langchain.schema import SystemMessage, HumanMessage
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Set
+import numpy as np
 from .database import EmbeddingDB
-from .embeddings import get_embedding
-from .indexer import CodebaseIndexer
+from .embedding_cache import EmbeddingCache
+from .embeddings import MODEL_NAME, EMBEDDING_DIM, get_embedding
+from .response_cache import ResponseCache
+from .source_file import hash_file, hash_source, line_offsets, map_source
 from dotenv import load_dotenv
 
+# LangChain and the tree-sitter indexer are imported where first used, so
+# importing this module stays cheap
+if TYPE_CHECKING:
+    from langchain.schema import AIMessage
+    from .indexer import CodebaseIndexer
+
 load_dotenv()
 logger = logging.getLogger(__name__)
+_JSON_DECODER = json.JSONDecoder()
+
+# The model is forced to answer through this tool, so changes arrive as parsed
+# arguments instead of JSON embedded in free-form text
+PROPOSE_CHANGES_TOOL = {
+    "name": "propose_changes",
+    "description": "Propose the minimal line-range edits that address the user's query.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "changes": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "file_path": {"type": "string", "description": "File to modify, relative to the project root"},
+                        "start_line": {"type": "integer", "description": "First line to replace (1-based)"},
+                        "end_line": {"type": "integer", "description": "Last line to replace (inclusive)"},
+                        "new_content": {"type": "string", "description": "Code that replaces ONLY the specified lines"},
+                        "reasoning": {"type": "string", "description": "Why this specific change is needed"}
+                    },
+                    "required": ["file_path", "start_line", "end_line", "new_content", "reasoning"]
+                }
+            }
+        },
+        "required": ["changes"]
+    }
+}
+REQUIRED_CHANGE_KEYS = PROPOSE_CHANGES_TOOL["input_schema"]["properties"]["changes"]["items"]["required"]
+
+SYSTEM_PROMPT = """You are a code modification assistant. Your job is to help users modify their codebase based on their queries.
+
+IMPORTANT INSTRUCTIONS:
+1. Make MINIMAL changes - only modify what's necessary to address the query
+2. Preserve existing imports, class/function signatures, and overall structure
+3. If adding new code, try to add it without replacing existing working code
+4. Be extremely careful with indentation and syntax
+5. Only modify the specific lines that need to change
+6. Do not rewrite entire functions unless absolutely necessary
+7. Preserve all existing functionality
+
+Return your changes by calling the propose_changes tool. For each change, provide:
+- file_path: The file to modify
+- start_line: Starting line number (be very precise)
+- end_line: Ending line number (be very precise)
+- new_content: The new code to replace ONLY the specified lines
+- reasoning: Why this specific change is needed
+
+Only suggest changes that directly address the user's query. Be precise with line numbers."""
+
+# The context comes first so follow-up queries over the same chunks share a cacheable prefix
+CONTEXT_PROMPT_TEMPLATE = """Relevant Code Context:
+{context}"""
+
+USER_PROMPT_TEMPLATE = """User Query: {query}
+
+Please analyze the code and provide the necessary changes to address the user's query."""
+
+@lru_cache(maxsize=1)
+def _get_llm():
+    # Built on the first query rather than at startup, and shared by every QueryProcessor
+    from langchain_anthropic import ChatAnthropic
+    return ChatAnthropic(
+        anthropic_api_key=os.getenv('ANTHROPIC_API_KEY'),
+        model_name="claude-3-5-sonnet-latest",
+        temperature=0.1
+    ).bind_tools([PROPOSE_CHANGES_TOOL], tool_choice=PROPOSE_CHANGES_TOOL["name"])
+
+CHUNK_CONTEXT_TEMPLATE = (
+    "File: {file_path}\n"
+    "Type: {chunk_type}\n"
+    "Name: {name}\n"
+    "Lines: {start_line}-{end_line}\n"
+    "Content:\n{content}\n---"
+)
+
+class MappedLines:
+    """A file's lines, memory-mapped and decoded one line at a time on access"""
+    
+    def __init__(self, file_path: Path):
+        self.data = map_source(file_path)
+        # Offsets come from the same helper the indexer numbers chunk lines with
+        self.offsets = line_offsets(self.data)
+        # The first line ending decides the one written into replacement lines
+        first_newline = int(self.offsets[1]) - 1 if len(self.offsets) > 2 else 0
+        self.newline = '\r\n' if first_newline and self.data[first_newline - 1:first_newline] == b'\r' else '\n'
+        self.ends_with_newline = self.data[-1:] == b'\n'
+    
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, index: int) -> str:
+        line = self.data[self.offsets[index]:self.offsets[index + 1]]
+        return line.decode('utf-8', errors='replace').rstrip('\r\n')
+    
+    def offset(self, index: int) -> int:
+        """Byte offset where 0-based line index starts, clamped to the end of the file"""
+        return int(self.offsets[min(max(index, 0), len(self))])
+    
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
 
 class QueryProcessor:
-    def __init__(self, project_path: Path):
+    # A query this close to an earlier one in the session reuses its search results
+    QUERY_REUSE_THRESHOLD = 0.98
+    RECENT_QUERY_LIMIT = 64
+    # A query this close to a cached one, over exactly the same code context, reuses its proposed changes
+    RESPONSE_REUSE_THRESHOLD = 0.95
+    QUERY_EMBEDDING_LIMIT = 1024
+    QUERY_CACHE_LIMIT = 10000
+    CHAT_HISTORY_LIMIT = 32
+    
+    def __init__(self, project_path: Path, response_reuse_threshold: float = RESPONSE_REUSE_THRESHOLD):
         self.project_path = project_path
         self.db = EmbeddingDB(project_path / ".codebase_index")
-        self.llm = ChatAnthropic(
-            anthropic_api_key=os.getenv('ANTHROPIC_API_KEY'),
-            model_name="claude-3-5-sonnet-latest",
-            temperature=0.1
+        self._query_cache = EmbeddingCache(
+            project_path / ".codebase_index" / "query_cache.db", MODEL_NAME, self.QUERY_CACHE_LIMIT
+        )
+        self._response_cache = ResponseCache(
+            project_path / ".codebase_index" / "response_cache.db", MODEL_NAME, response_reuse_threshold
         )
-        self.chat_history = []
+        self._query_embeddings = OrderedDict()
+        # Only the recent turns are kept, so a long session doesn't hold every response
+        self.chat_history = deque(maxlen=self.CHAT_HISTORY_LIMIT)
+        self._forget_recent_queries()
+        # Re-indexing after an edit runs here while the user types the next query;
+        # one worker keeps the indexer and its SQLite connection on one thread
+        self._index_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_index = None
+        self.auto_confirm = bool(os.getenv('CODEBASE_AI_YES'))
+        self.show_previews = sys.stdout.isatty() and not self.auto_confirm
         
     def process_query(self, query: str):
         """Main entry point for processing user queries"""
         print(f"Analyzing query: {query}")
         
         # Find relevant code chunks
-        relevant_chunks = self._find_relevant_chunks(query)
+        try:
+            query_embedding = self._embed_query(query)
+        except Exception as e:
+            print(f"Error embedding query, so the codebase can't be searched for it: {e}")
+            return
+        
+        relevant_chunks = self._find_relevant_chunks(query_embedding)
         if not relevant_chunks:
             print("No relevant code found for your query.")
             return
         
         print(f"Found {len(relevant_chunks)} relevant code chunks")
         
-        # Generate and apply changes
-        response = self._generate_response(query, relevant_chunks)
-        changes = self._parse_changes(response)
+        # Generate and apply changes, skipping the LLM when a near-identical query
+        # was already answered over the same code
+        context = self._build_context(relevant_chunks)
+        context_key = self._response_cache.context_key(context)
         
-        if changes:
-            self._apply_changes(changes)
+        # A cached change set only replays onto files exactly as they were when it was
+        # first applied, e.g. after the edit was reverted
+        cached = None
+        for candidate, file_hashes in self._response_cache.candidates(context_key, query_embedding):
+            if self._files_match(file_hashes):
+                cached = candidate
+                break
+        
+        if cached is not None:
+            print("Reusing the changes proposed for a similar earlier query")
+            changes = cached
         else:
+            response = self._generate_response(query, context)
+            changes = self._extract_changes(response)
+        
+        if not changes:
             print("No changes generated or invalid response format.")
+            return
+        
+        # Only a change set that validated, was confirmed and got written is worth replaying
+        file_hashes = self._apply_changes(changes)
+        if file_hashes is not None and cached is None:
+            self._response_cache.put(context_key, query_embedding, changes, file_hashes)
+    
+    def _files_match(self, file_hashes: Dict[str, str]) -> bool:
+        """Check every file still has the content hash recorded for it"""
+        try:
+            return all(hash_file(self.project_path / file_path) == expected
+                       for file_path, expected in file_hashes.items())
+        except OSError:
+            return False
     
-    def _find_relevant_chunks(self, query: str) -> List[Dict[str, Any]]:
+    def _find_relevant_chunks(self, query_embedding: np.ndarray) -> List[Dict[str, Any]]:
         """Find code chunks relevant to the query"""
-        query_embedding = get_embedding(query)
-        return self.db.similarity_search(query_embedding, top_k=5)
+        # Results must reflect the last applied edit
+        self._wait_for_index()
+        
+        unit = query_embedding / np.linalg.norm(query_embedding)
+        if len(self._recent_results):
+            scores = self._recent_vectors @ unit
+            best = int(np.argmax(scores))
+            if scores[best] >= self.QUERY_REUSE_THRESHOLD:
+                return self._recent_results[best]
+        
+        results = self.db.similarity_search(query_embedding, top_k=5)
+        self._recent_vectors = np.vstack([self._recent_vectors, unit])[-self.RECENT_QUERY_LIMIT:]
+        self._recent_results = (self._recent_results + [results])[-self.RECENT_QUERY_LIMIT:]
+        return results
+    
+    def _embed_query(self, query: str) -> np.ndarray:
+        """Embed the query, reusing the embedding of a query seen before in this session or on disk"""
+        # The model's tokenizer is uncased, so case and whitespace don't change the embedding
+        normalized = " ".join(query.lower().split())
+        embedding = self._query_embeddings.get(normalized)
+        if embedding is not None:
+            self._query_embeddings.move_to_end(normalized)
+            return embedding
+        
+        embedding = self._query_cache.get_or_compute(normalized, lambda: get_embedding(normalized))
+        self._query_embeddings[normalized] = embedding
+        if len(self._query_embeddings) > self.QUERY_EMBEDDING_LIMIT:
+            self._query_embeddings.popitem(last=False)
+        return embedding
     
-    def _generate_response(self, query: str, chunks: List[Dict[str, Any]]) -> str:
+    @cached_property
+    def _indexer(self) -> 'CodebaseIndexer':
+        """Indexer for re-indexing edited files, created on the first applied edit"""
+        from .indexer import CodebaseIndexer
+        return CodebaseIndexer(self.project_path)
+    
+    def _forget_recent_queries(self):
+        """Drop remembered query results, e.g. once an edit changes the index"""
+        self._recent_vectors = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        self._recent_results = []
+    
+    def _generate_response(self, query: str, context: str) -> Optional['AIMessage']:
         """Generate LLM response with code context"""
-        context = self._build_context(chunks)
-        user_prompt = f"""User Query: {query}
-
-Relevant Code Context:
-{context}
-
-Please analyze the code and provide the necessary changes to address the user's query."""
+        from langchain.schema import SystemMessage, HumanMessage
         
+        # The tools and system prompt are the same on every call, and the context
+        # repeats whenever a follow-up retrieves the same chunks, so each ends a
+        # cacheable prefix for Anthropic's prompt cache
         messages = [
-            SystemMessage(content=self._get_system_prompt()),
-            HumanMessage(content=user_prompt)
+            SystemMessage(content=[
+                {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+            ]),
+            HumanMessage(content=[
+                {
+                    "type": "text",
+                    "text": CONTEXT_PROMPT_TEMPLATE.format_map({'context': context}),
+                    "cache_control": {"type": "ephemeral"}
+                },
+                {"type": "text", "text": USER_PROMPT_TEMPLATE.format_map({'query': query})}
+            ])
         ]
         
         try:
-            response = self.llm.invoke(messages)
+            response = _get_llm().invoke(messages)
             response_text = self._extract_response_text(response)
             
             # Log the full LLM response for debugging
-            logger.info(f"LLM Response for query '{query[:50]}...':")
-            logger.info(f"Full response: {response_text}")
-            logger.info("-" * 80)
+            logger.info("LLM response for query %r: %s", query[:50], response_text)
             
             # Update chat history
             self.chat_history.extend([
@@ -82,29 +291,33 @@ Please analyze the code and provide the necessary changes to address the user's
                 {'role': 'assistant', 'content': response_text}
             ])
             
-            return response_text
+            return response
             
         except Exception as e:
-            logger.error(f"Error in LLM invoke: {e}")
+            logger.error("Error in LLM invoke: %s", e)
             print(f"Error in LLM invoke: {e}")
-            return ""
+            return None
     
     def _build_context(self, chunks: List[Dict[str, Any]]) -> str:
         """Build code context from relevant chunks"""
-        context_parts = []
-        for chunk in chunks:
-            context_parts.append(
-                f"File: {chunk['file_path']}\n"
-                f"Type: {chunk['chunk_type']}\n"
-                f"Name: {chunk['name']}\n"
-                f"Lines: {chunk['start_line']}-{chunk['end_line']}\n"
-                f"Content:\n{chunk['content']}\n---"
-            )
-        return "\n".join(context_parts)
+        return "\n".join(CHUNK_CONTEXT_TEMPLATE.format_map(chunk) for chunk in chunks)
+    
+    def _extract_changes(self, response: Optional['AIMessage']) -> List[Dict[str, Any]]:
+        """Read the changes from the propose_changes tool call, falling back to JSON in the text"""
+        if response is None:
+            return []
+        
+        for tool_call in response.tool_calls:
+            if tool_call['name'] == PROPOSE_CHANGES_TOOL["name"]:
+                return tool_call['args'].get('changes', [])
+        
+        return self._parse_changes(self._extract_response_text(response))
     
     def _extract_response_text(self, response) -> str:
         """Extract text content from LLM response"""
-        if hasattr(response, 'content'):
+        if getattr(response, 'tool_calls', None):
+            return json.dumps(response.tool_calls[0]['args'])
+        elif hasattr(response, 'content'):
             return response.content
         elif hasattr(response, 'text'):
             return response.text
@@ -119,35 +332,19 @@ Please analyze the code and provide the necessary changes to address the user's
             return []
         
         try:
-            # Find the JSON block that contains "changes" with different formatting
-            patterns = [
-                '{\n  "changes"',  # spaced formatting
-                '{\n"changes"',    # no space formatting
-                '{"changes"'       # inline formatting
-            ]
-            
-            start_idx = -1
-            for pattern in patterns:
-                start_idx = response.find(pattern)
+            # raw_decode parses one object from an offset and ignores what follows it,
+            # so braces inside string values (common in code) can't end it early
+            key_idx = response.find('"changes"')
+            while key_idx != -1:
+                start_idx = response.rfind('{', 0, key_idx)
                 if start_idx != -1:
-                    break
-            
-            if start_idx != -1:
-                # Count braces to find the end of the JSON object
-                brace_count = 0
-                end_idx = start_idx
-                for i, char in enumerate(response[start_idx:]):
-                    if char == '{':
-                        brace_count += 1
-                    elif char == '}':
-                        brace_count -= 1
-                        if brace_count == 0:
-                            end_idx = start_idx + i + 1
-                            break
-                
-                json_str = response[start_idx:end_idx]
-                changes_data = json.loads(json_str)
-                return changes_data.get('changes', [])
+                    try:
+                        changes_data, _ = _JSON_DECODER.raw_decode(response, start_idx)
+                        if isinstance(changes_data, dict) and 'changes' in changes_data:
+                            return changes_data['changes']
+                    except json.JSONDecodeError:
+                        pass
+                key_idx = response.find('"changes"', key_idx + 1)
             
             return []
         
@@ -155,69 +352,175 @@ Please analyze the code and provide the necessary changes to address the user's
             print(f"Error parsing changes: {e}")
             return []
     
-    def _apply_changes(self, changes: List[Dict[str, Any]]):
-        """Apply code changes to files"""
+    def _apply_changes(self, changes: List[Dict[str, Any]]) -> Optional[Dict[str, str]]:
+        """Apply code changes to files, returning their pre-edit content hashes when every file was written"""
         if not changes:
-            return
+            return None
         
-        # Show changes and ask for confirmation
-        if not self._show_changes_and_confirm(changes):
-            print("Changes cancelled by user.")
-            return
+        if not self._well_formed(changes):
+            print("Changes rejected, the response did not contain a list of complete changes.")
+            return None
         
+        changes_by_file = {}
         for change in changes:
+            changes_by_file.setdefault(self._project_file(change['file_path']), []).append(change)
+        
+        # Files mapped for validation are reused for the preview and when applying, so each is opened once
+        file_lines = self._read_files({file_path for file_path in changes_by_file if self._inside_project(file_path)})
+        try:
+            # Nothing is written unless every change fits its file, so a bad range can't leave a half-applied batch
+            problems = self._validate_changes(changes_by_file, file_lines)
+            if problems:
+                print("Changes rejected, no files were modified:")
+                for problem in problems:
+                    print(f"  {problem}")
+                return None
+            
+            # Show changes and ask for confirmation
+            if not self._show_changes_and_confirm(changes, file_lines):
+                print("Changes cancelled by user.")
+                return None
+            
+            modified = {}
+            original_hashes = {}
+            for file_path, file_changes in changes_by_file.items():
+                try:
+                    lines = file_lines.pop(file_path)
+                    try:
+                        original_hashes[str(file_path.relative_to(self.project_path))] = hash_source(lines.data)
+                        segments = self._splice_changes(file_path, lines, file_changes)
+                    finally:
+                        # Unmapped before the replace, which Windows refuses on a mapped file
+                        lines.close()
+                    
+                    self._write_atomically(file_path, segments)
+                    print(f"Successfully modified {file_path}")
+                    modified[file_path] = None
+                    
+                except Exception as e:
+                    print(f"Error applying changes to {file_path}: {e}")
+        finally:
+            for lines in file_lines.values():
+                lines.close()
+        
+        # One indexer pass for every touched file, so their chunks embed in shared batches
+        if modified:
+            self._update_index(list(modified))
+        return original_hashes if len(modified) == len(changes_by_file) else None
+    
+    def _well_formed(self, changes: Any) -> bool:
+        """Check the changes are a list of dicts carrying every field the tool schema requires"""
+        return isinstance(changes, list) and all(
+            isinstance(change, dict)
+            and all(key in change for key in REQUIRED_CHANGE_KEYS)
+            and isinstance(change['file_path'], str)
+            and isinstance(change['new_content'], str)
+            for change in changes
+        )
+    
+    def _project_file(self, file_path: str) -> Path:
+        """Resolve a change's file_path, as a path under the project root when it lies inside it"""
+        # '..' and symlinks are resolved, so the indexer sees one relative path per file
+        root = self.project_path.resolve()
+        target = (root / file_path).resolve()
+        return self.project_path / target.relative_to(root) if target.is_relative_to(root) else target
+    
+    def _inside_project(self, file_path: Path) -> bool:
+        return file_path.resolve().is_relative_to(self.project_path.resolve())
+    
+    def _read_files(self, file_paths: Set[Path]) -> Dict[Path, MappedLines]:
+        """Map the files and index their lines concurrently, leaving out any that can't be read"""
+        def read(file_path: Path) -> Optional[MappedLines]:
             try:
-                file_path = self.project_path / change['file_path']
-                
-                if not file_path.exists():
-                    print(f"File not found: {file_path}")
-                    continue
-                
-                self._apply_single_change(file_path, change)
-                self._update_file_index(file_path)
-                
-            except Exception as e:
-                print(f"Error applying change to {change['file_path']}: {e}")
+                return MappedLines(file_path)
+            except OSError:
+                # Reported by _validate_changes
+                return None
+        
+        with ThreadPoolExecutor(max_workers=min(len(file_paths), 8) or 1) as pool:
+            results = dict(zip(file_paths, pool.map(read, file_paths)))
+        return {file_path: lines for file_path, lines in results.items() if lines is not None}
+    
+    def _validate_changes(self, changes_by_file: Dict[Path, List[Dict[str, Any]]], file_lines: Dict[Path, MappedLines]) -> List[str]:
+        """Check every change's line range against its file and return a description of each problem"""
+        problems = []
+        for file_path, file_changes in changes_by_file.items():
+            # Confirmation can be skipped (CODEBASE_AI_YES), so nothing outside the project is ever written
+            if not self._inside_project(file_path):
+                problems.append(f"{file_path}: outside the project")
+                continue
+            
+            lines = file_lines.get(file_path)
+            if lines is None:
+                problems.append(f"{file_path}: file not found or unreadable")
+                continue
+            
+            ranges = []
+            for change in file_changes:
+                start_line, end_line = change['start_line'], change['end_line']
+                if isinstance(start_line, int) and isinstance(end_line, int):
+                    ranges.append((start_line, end_line))
+                else:
+                    problems.append(f"{file_path}: non-integer line range {start_line!r}-{end_line!r}")
+            
+            # The empty "line" after a final newline isn't one the model can edit
+            line_count = len(lines) - lines.ends_with_newline
+            previous_end = 0
+            for start_line, end_line in sorted(ranges):
+                # end_line = start_line - 1 inserts before start_line without replacing anything
+                if start_line < 1 or end_line < start_line - 1 or end_line > line_count:
+                    problems.append(f"{file_path}: lines {start_line}-{end_line} out of range (file has {line_count} lines)")
+                elif start_line <= previous_end:
+                    problems.append(f"{file_path}: lines {start_line}-{end_line} overlap an earlier change")
+                else:
+                    previous_end = end_line
+        return problems
     
-    def _show_changes_and_confirm(self, changes: List[Dict[str, Any]]) -> bool:
+    def _show_changes_and_confirm(self, changes: List[Dict[str, Any]], file_lines: Dict[Path, MappedLines]) -> bool:
         """Show proposed changes to user and ask for confirmation"""
-        print("\n" + "="*60)
-        print("PROPOSED CHANGES")
-        print("="*60)
+        # CODEBASE_AI_YES applies without asking, so there's nobody to show a preview to
+        if self.auto_confirm:
+            return True
         
+        # Code blocks only when a terminal will show them; the output is written at once
+        out = ["", "=" * 60, "PROPOSED CHANGES", "=" * 60]
         for i, change in enumerate(changes, 1):
-            print(f"\nChange {i}:")
-            print(f"File: {change['file_path']}")
-            print(f"Lines: {change['start_line']}-{change['end_line']}")
-            print(f"Reasoning: {change['reasoning']}")
+            out.append(f"\nChange {i}:")
+            out.append(f"File: {change['file_path']}")
+            out.append(f"Lines: {change['start_line']}-{change['end_line']}")
+            out.append(f"Reasoning: {change['reasoning']}")
             
-            # Show current code
             file_path = self.project_path / change['file_path']
-            if file_path.exists():
+            if not self.show_previews:
+                continue
+            
+            # Show current code
+            if file_path in file_lines:
                 try:
-                    lines = file_path.read_text().splitlines()
+                    lines = file_lines[file_path]
                     start_idx = change['start_line'] - 1
                     end_idx = change['end_line'] - 1
                     
-                    print(f"\nCurrent code:")
-                    print("-" * 40)
+                    out.append("\nCurrent code:")
+                    out.append("-" * 40)
                     for line_num in range(start_idx, min(end_idx + 1, len(lines))):
-                        print(f"{line_num + 1:3d}: {lines[line_num]}")
-                    print("-" * 40)
+                        out.append(f"{line_num + 1:3d}: {lines[line_num]}")
+                    out.append("-" * 40)
                     
-                    print(f"\nNew code:")
-                    print("-" * 40)
+                    out.append("\nNew code:")
+                    out.append("-" * 40)
                     new_lines = change['new_content'].splitlines()
                     for line_num, line in enumerate(new_lines, start=change['start_line']):
-                        print(f"{line_num:3d}: {line}")
-                    print("-" * 40)
+                        out.append(f"{line_num:3d}: {line}")
+                    out.append("-" * 40)
                     
                 except Exception as e:
-                    print(f"Error reading file: {e}")
+                    out.append(f"Error reading file: {e}")
             else:
-                print(f"Warning: File {change['file_path']} not found!")
+                out.append(f"Warning: File {change['file_path']} not found!")
         
-        print("\n" + "="*60)
+        out.append("\n" + "=" * 60)
+        sys.stdout.write("\n".join(out) + "\n")
         
         # Ask for confirmation
         while True:
@@ -230,26 +533,55 @@ Please analyze the code and provide the necessary changes to address the user's
             else:
                 print("Please enter 'y' for yes or 'n' for no.")
     
-    def _apply_single_change(self, file_path: Path, change: Dict[str, Any]):
-        """Apply a single change to a file"""
-        print(f"Applying change to {file_path}")
-        print(f"Reasoning: {change['reasoning']}")
-        
-        lines = file_path.read_text().splitlines()
-        start_idx = change['start_line'] - 1
-        end_idx = change['end_line'] - 1
-        
-        # Show before/after
-        self._show_change_preview(lines, change, start_idx, end_idx)
-        
-        # Apply change
-        new_lines = change['new_content'].splitlines()
-        modified_lines = lines[:start_idx] + new_lines + lines[end_idx + 1:]
-        file_path.write_text('\n'.join(modified_lines))
+    def _splice_changes(self, file_path: Path, lines: MappedLines, changes: List[Dict[str, Any]]) -> List[bytes]:
+        """Apply a file's changes to its original lines in one pass and return the new file as byte segments"""
+        # Every change's line numbers refer to the original file, so walking them in
+        # order and copying the untouched byte ranges between them builds the result
+        # once; only the replaced lines are ever decoded (for the preview)
+        segments = []
+        position = 0
+        for change in sorted(changes, key=lambda change: (change['start_line'], change['end_line'])):
+            print(f"Applying change to {file_path}")
+            print(f"Reasoning: {change['reasoning']}")
+            
+            start_idx = change['start_line'] - 1
+            end_idx = change['end_line'] - 1
+            
+            # Show before/after
+            if self.show_previews:
+                self._show_change_preview(lines, change, start_idx, end_idx)
+            
+            new_text = ''.join(line + lines.newline for line in change['new_content'].splitlines())
+            # A file without a final newline keeps it missing: text appended after the
+            # last line is separated from it instead, and a replacement of the last
+            # line drops its own trailing newline
+            if new_text and not lines.ends_with_newline:
+                if start_idx >= len(lines):
+                    new_text = lines.newline + new_text[:-len(lines.newline)]
+                elif end_idx + 1 >= len(lines):
+                    new_text = new_text[:-len(lines.newline)]
+            
+            start_offset = lines.offset(start_idx)
+            segments.append(lines.data[position:max(position, start_offset)])
+            segments.append(new_text.encode('utf-8'))
+            position = max(position, lines.offset(end_idx + 1))
+        segments.append(lines.data[position:])
         
-        print(f"Successfully modified {file_path}")
+        return segments
     
-    def _show_change_preview(self, lines: List[str], change: Dict[str, Any], start_idx: int, end_idx: int):
+    def _write_atomically(self, file_path: Path, segments: List[bytes]):
+        """Write the segments to a sibling temp file and swap it in, so a crash never leaves a half-written file"""
+        tmp_path = file_path.with_name(file_path.name + '.tmp')
+        try:
+            with open(tmp_path, 'wb', buffering=1 << 20) as f:
+                f.writelines(segments)
+            shutil.copymode(file_path, tmp_path)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    
+    def _show_change_preview(self, lines: MappedLines, change: Dict[str, Any], start_idx: int, end_idx: int):
         """Show before/after preview of changes"""
         print(f"\nCode before change (lines {change['start_line']}-{change['end_line']}):")
         print("=" * 50)
@@ -263,51 +595,26 @@ Please analyze the code and provide the necessary changes to address the user's
             print(f"{i:3d}: {line}")
         print("=" * 50)
     
-    def _update_file_index(self, file_path: Path):
-        """Update the search index for a modified file"""
+    def _update_index(self, file_paths: List[Path]):
+        """Re-index modified files in the background; the next search waits for it"""
+        print(f"Updating index for {len(file_paths)} modified file(s) in the background")
+        self._pending_index = self._index_executor.submit(self._reindex, file_paths)
+    
+    def _wait_for_index(self):
+        """Block until a background re-index has finished"""
+        if self._pending_index is not None:
+            self._pending_index.result()
+            self._pending_index = None
+    
+    def _reindex(self, file_paths: List[Path]):
+        """Update the search index for modified files"""
         try:
-            relative_path = file_path.relative_to(self.project_path)
-            self.db.remove_chunks_for_file(str(relative_path))
-            
-            indexer = CodebaseIndexer(self.project_path)
-            indexer._index_file(file_path)
-            
-            print(f"Updated index for {file_path}")
+            # Forced because an edit can keep a file's size and land within its mtime
+            # resolution; unchanged chunks still keep their stored embeddings
+            _, failed = self._indexer.index_files(file_paths, force=True)
+            self._forget_recent_queries()
+            if failed:
+                print(f"Error updating index for {failed} modified file(s) (see manage.log)")
             
         except Exception as e:
-            print(f"Error updating index for {file_path}: {e}")
-    
-    def _get_system_prompt(self) -> str:
-        """Get the system prompt for the LLM"""
-        return """You are a code modification assistant. Your job is to help users modify their codebase based on their queries.
-
-IMPORTANT INSTRUCTIONS:
-1. Make MINIMAL changes - only modify what's necessary to address the query
-2. Preserve existing imports, class/function signatures, and overall structure
-3. If adding new code, try to add it without replacing existing working code
-4. Be extremely careful with indentation and syntax
-5. Only modify the specific lines that need to change
-6. Do not rewrite entire functions unless absolutely necessary
-7. Preserve all existing functionality
-
-For each change, provide a JSON response with:
-- file_path: The file to modify
-- start_line: Starting line number (be very precise)
-- end_line: Ending line number (be very precise)
-- new_content: The new code to replace ONLY the specified lines
-- reasoning: Why this specific change is needed
-
-Response format:
-{
-"changes": [
-    {
-    "file_path": "path/to/file.py",
-    "start_line": 10,
-    "end_line": 10,
-    "new_content": "    # Only the specific line(s) that need to change",
-    "reasoning": "explanation of change"
-    }
-]
-}
-
-Only suggest changes that directly address the user's query. Be precise with line numbers."""
\ No newline at end of file
+            print(f"Error updating index: {e}")
\ No newline at end of file
@@ -0,0 +1,74 @@
+# response_cache.py
+import json
+import sqlite3
+from pathlib import Path
+from typing import List, Dict, Any, Tuple
+import blake3
+import numpy as np
+
+# Bump when the stored vector layout changes
+CACHE_FORMAT = 3
+
+class ResponseCache:
+    """Persistent cache of proposed changes, matched by query similarity within an identical code context"""
+    
+    # Oldest entries are dropped past this many
+    MAX_ENTRIES = 10000
+    
+    def __init__(self, cache_path: Path, model_name: str, threshold: float):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.conn = sqlite3.connect(str(cache_path))
+        
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != CACHE_FORMAT:
+            with self.conn:
+                self.conn.execute("DROP TABLE IF EXISTS responses")
+                self.conn.execute(f"PRAGMA user_version = {CACHE_FORMAT}")
+        
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    context_key TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    changes TEXT NOT NULL,
+                    file_hashes TEXT NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_context_key ON responses (context_key)")
+    
+    def context_key(self, context: str) -> str:
+        # The context holds the retrieved chunks' content, so any edit to that code
+        # gives a new key and an answer about the old code is never replayed
+        return blake3.blake3(f"{self.model_name}\0{context}".encode()).hexdigest(length=16)
+    
+    def candidates(self, context_key: str,
+                   query_embedding: np.ndarray) -> List[Tuple[List[Dict[str, Any]], Dict[str, str]]]:
+        """Cached (changes, file_hashes) pairs similar enough to the query, most similar first"""
+        rows = self.conn.execute(
+            "SELECT vector, changes, file_hashes FROM responses WHERE context_key = ?", (context_key,)
+        ).fetchall()
+        if not rows:
+            return []
+        
+        # Stored vectors are unit length, so cosine similarity is a dot product;
+        # float16 is ample precision for comparing against the threshold
+        vectors = np.frombuffer(b"".join(row[0] for row in rows), dtype=np.float16).reshape(len(rows), -1)
+        vectors = vectors.astype(np.float32)
+        scores = vectors @ (query_embedding / np.linalg.norm(query_embedding))
+        return [
+            (json.loads(rows[i][1]), json.loads(rows[i][2]))
+            for i in np.argsort(-scores) if scores[i] >= self.threshold
+        ]
+    
+    def put(self, context_key: str, query_embedding: np.ndarray, changes: List[Dict[str, Any]],
+            file_hashes: Dict[str, str]):
+        # file_hashes holds each target file's content hash from before the changes were
+        # applied; the context alone can't tell whether they already have been
+        unit = np.asarray(query_embedding / np.linalg.norm(query_embedding), dtype=np.float16)
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?)",
+                (context_key, unit.tobytes(), json.dumps(changes), json.dumps(file_hashes))
+            )
+            # rowids only grow, so everything this far behind the newest row is the oldest
+            self.conn.execute("DELETE FROM responses WHERE rowid <= ?", (cursor.lastrowid - self.MAX_ENTRIES,))
\ No newline at end of file
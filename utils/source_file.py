@@ -0,0 +1,33 @@
+# source_file.py
+import mmap
+import os
+from pathlib import Path
+from typing import Union
+import blake3
+import numpy as np
+
+def map_source(file_path: Path) -> Union[bytes, mmap.mmap]:
+    """Memory-map a file read-only, or return b'' for an empty one (which mmap can't map)"""
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return b''
+
+def line_offsets(source: Union[bytes, mmap.mmap]) -> np.ndarray:
+    """Byte offsets where each line starts, plus the end of the source as a final entry"""
+    # offsets[i] is where line i + 1 starts. Lines split on '\n' only, as tree-sitter
+    # counts rows, so chunk line numbers and the lines edits are applied to agree
+    newlines = np.flatnonzero(np.frombuffer(source, dtype=np.uint8) == ord('\n'))
+    return np.concatenate(([0], newlines + 1, [len(source)]))
+
+def hash_source(source: Union[bytes, mmap.mmap]) -> str:
+    """BLAKE3 fingerprint of a file's bytes, as recorded in the index's file_state"""
+    return blake3.blake3(source).hexdigest(length=16)
+
+def hash_file(file_path: Path) -> str:
+    source = map_source(file_path)
+    try:
+        return hash_source(source)
+    finally:
+        if isinstance(source, mmap.mmap):
+            source.close()
\ No newline at end of file